@@ -1,47 +1,177 @@
 # debate_system.py
-from typing import List, Dict
-from dataclasses import dataclass
+from typing import ClassVar, List, Dict, Optional, Tuple
+from dataclasses import dataclass, field
+import asyncio
+import itertools
 import random
+from operator import attrgetter
 from graphviz import Digraph
-import json
+import logging
+import orjson
+import os
+import re
 import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-@dataclass
+# Input files handed to a single `dot` process; more trees than this are split
+# across a few processes rendering in parallel.
+DOT_BATCH_SIZE = 8
+
+# Markdown fence the model often wraps its JSON in
+_JSON_FENCE = re.compile(r"```(?:json)?", re.IGNORECASE)
+# A flat JSON object (rubric replies never nest), wherever it sits in the reply
+_JSON_OBJECT = re.compile(r"\{[^{}]*\}")
+# The "response" string of a rubric object, even one cut off by the token limit
+_RESPONSE_FIELD = re.compile(r'"response"\s*:\s*"((?:[^"\\]|\\.)*)')
+
+def _load_json(reply: str):
+    """Parse a JSON reply from the LLM, tolerating a surrounding ```json fence"""
+    return orjson.loads(_JSON_FENCE.sub('', reply))
+
+def _split_scored_reply(reply: str) -> Tuple[str, Optional[Dict]]:
+    """Split a fused response + rubric reply into the response text and the rubric.
+
+    Models often write the response as prose and append the JSON object after it, so
+    the last parseable object is the rubric; the rubric is None when none parses.
+    """
+    for match in reversed(list(_JSON_OBJECT.finditer(reply))):
+        try:
+            data = orjson.loads(match.group())
+        except ValueError:
+            continue
+        if isinstance(data, dict):
+            response = data.get('response')
+            if isinstance(response, str) and response.strip():
+                return response.strip(), data
+            return _JSON_FENCE.sub('', reply[:match.start()]).strip(), data
+    field = _RESPONSE_FIELD.search(reply)
+    if field is None:
+        return _JSON_FENCE.sub('', reply).strip(), None
+    try:
+        return orjson.loads(f'"{field.group(1)}"').strip(), None
+    except ValueError:  # cut off inside an escape sequence
+        return field.group(1).strip(), None
+
+@dataclass(slots=True)
 class DebateNode:
     content: str
-    children: List['DebateNode'] = None
+    children: List['DebateNode'] = field(default_factory=list)
     score: float = 0.0
 
-    def __post_init__(self):
-        if self.children is None:
-            self.children = []
-
 class DebateAgent:
+    # Prompts are split into a fixed system prefix and a per-call suffix so Ollama
+    # can reuse the prefix's KV cache instead of re-running its prefill.
+    SCORE_SYSTEM = sys.intern("""Rate the response on a scale of 1-10 for:
+            1. Logical consistency
+            2. Evidence quality
+            3. Persuasiveness
+            Return JSON format with keys: logic, evidence, persuasiveness""")
+    SCORE_TEMPLATE = sys.intern("Response: {response}")
+
+    RESPONSE_SYSTEM_TEMPLATE = sys.intern("""As a {position} debater on AI in education, craft a response that:
+        1. Acknowledges 1 valid point from the opponent's statement
+        2. Presents 2 counterpoints from the evidence given
+        3. Concludes with a strong position statement
+        Respond in exactly 3 sentences.""")
+    RESPONSE_TEMPLATE = sys.intern("""Opponent's statement: {quote}
+        Evidence: {evidence}""")
+
+    # Longest prefix of an opponent's statement that any prompt of this agent uses
+    EXCERPT_CHARS = 200
+    # Prefix of the statement quoted back in the response prompt
+    QUOTE_CHARS = 200
+
+    # Decode budgets: a rubric JSON blob is ~30 tokens, an opponent analysis ~100
+    SCORE_MAX_TOKENS = 40
+    ANALYSIS_MAX_TOKENS = 120
+
+    # Rubric weights for logic, evidence and persuasiveness
+    SCORE_WEIGHTS = (0.4, 0.3, 0.3)
+
+    SCORED_RESPONSE_FORMAT = sys.intern("""
+        Rate your response 1-10 for logic, evidence and persuasiveness.
+        Reply with this JSON object only, with no text before or after it:
+        {"response": "...", "logic": N, "evidence": N, "persuasiveness": N}""")
+
     def __init__(self, position: str, llm: 'LLMWrapper', knowledge_base: List[str],
-                 max_depth: int = 2, max_breadth: int = 2):
+                 max_depth: int = 2, max_breadth: int = 2, visualize: Optional[bool] = None,
+                 prune_threshold: float = 0.85):
         self.position = position
         self.llm = llm
         self.knowledge_base = knowledge_base
+        # System prompts depend only on the position, so they are formatted once per agent
+        self._response_system = self.RESPONSE_SYSTEM_TEMPLATE.format_map({'position': position})
+        self._scored_response_system = self._response_system + self.SCORED_RESPONSE_FORMAT
+        # Every evidence pair a response can cite, so each prompt costs one random.choice
+        self._kb_pairs = [', '.join(pair) for pair in itertools.combinations(knowledge_base, 2)]
         self.max_depth = max_depth
         self.max_breadth = max_breadth
+        # A sibling scoring at least this much is the only one expanded further
+        # (scores are in [0, 1]; anything above 1.0 disables pruning)
+        self.prune_threshold = prune_threshold
+        self._score_cache: Dict[str, asyncio.Future] = {}
+        # Tree rendering is a debugging aid: off unless requested or DEBATE_VIZ=1
+        if visualize is None:
+            visualize = os.getenv('DEBATE_VIZ') == '1'
+        self.visualize_enabled = visualize
 
-    def build_rehearsal_tree(self, opponent_statement: str, depth: int = None) -> DebateNode:
+    async def build_rehearsal_tree(self, opponent_statement: str, depth: int = None) -> DebateNode:
+        """Expand the tree level by level, sending each level's LLM calls concurrently"""
         if depth is None:
             depth = self.max_depth
-        root = DebateNode(opponent_statement)
+        self._score_cache.clear()
 
-        def expand(node, current_depth):
-            if current_depth == 0:
-                node.score = self.score_response(node.content)
-                return
-            for _ in range(self.max_breadth):
-                response = self.generate_response(node.content)
-                child = DebateNode(response)
-                node.children.append(child)
-                expand(child, current_depth - 1)
+        # Level-order arrays: the children of node i occupy i*breadth+1 .. i*breadth+breadth
+        breadth = self.max_breadth
+        size = sum(breadth ** d for d in range(depth + 1))
+        contents: List[Optional[str]] = [None] * size
+        scores = [0.0] * size
+        parents = [-1] * size
+        contents[0] = opponent_statement
+        if depth == 0:
+            # The root is then the only leaf; leaves deeper down are scored by the fused call
+            scores[0] = await self.ascore_response(opponent_statement)
+
+        frontier = [0]
+        # With no breadth there is nothing to expand (and no sibling groups to step through)
+        for _ in range(depth if breadth else 0):
+            # Slice each parent's statement once, shared by all of its children's prompts
+            excerpts = {parent: contents[parent][:self.EXCERPT_CHARS] for parent in frontier}
+            quotes = {parent: excerpt[:self.QUOTE_CHARS] for parent, excerpt in excerpts.items()}
+            # Likewise read the opponent once per parent rather than once per child
+            readings = await self._aread_opponents([excerpts[parent] for parent in frontier])
+            opponent_models = dict(zip(frontier, readings))
+            level = [idx for parent in frontier
+                     for idx in range(parent * breadth + 1, parent * breadth + breadth + 1)]
+            for idx in level:
+                parents[idx] = (idx - 1) // breadth
+            # The LLM wrapper's shared queue bounds concurrency and runs shortest prompts first
+            replies = await asyncio.gather(
+                *(self.agenerate_scored_response(quotes[parents[idx]],
+                                                 opponent_models[parents[idx]],
+                                                 sample=(idx - 1) % breadth)
+                  for idx in level)
+            )
+            for idx, (response, score) in zip(level, replies):
+                contents[idx] = response
+                scores[idx] = score
+
+            frontier = []
+            for first in range(0, len(level), breadth):
+                siblings = level[first:first + breadth]
+                best = max(siblings, key=scores.__getitem__)
+                # select_best_path is greedy, so a clearly winning sibling already decides
+                # this level: skip the LLM calls for the others' subtrees
+                frontier.extend([best] if scores[best] >= self.prune_threshold else siblings)
 
-        expand(root, depth)
-        return root
+        # Materialize nodes once, for path selection and visualization; pruned slots stay empty
+        nodes = [DebateNode(content, score=score) if content is not None else None
+                 for content, score in zip(contents, scores)]
+        for idx in range(1, size):
+            if nodes[idx] is not None:
+                nodes[parents[idx]].children.append(nodes[idx])
+        return nodes[0]
 
     def select_best_path(self, tree: DebateNode) -> List[DebateNode]:
         best_path = []
@@ -50,46 +180,73 @@ class DebateAgent:
             best_path.append(node)
             if not node.children:
                 return
-            best_child = max(node.children, key=lambda c: c.score)
+            best_child = max(node.children, key=attrgetter('score'))
             recurse(best_child)
 
         recurse(tree)
         return best_path
 
-    def generate_response(self, opponent_statement: str) -> str:
-        prompt = f"""As a {self.position} debater on AI in education, craft a response that:
-        1. Acknowledges 1 valid point from: {opponent_statement[:200]}
-        2. Presents 2 counterpoints from: {', '.join(random.sample(self.knowledge_base, 2))}
-        3. Concludes with a strong position statement
-        Respond in exactly 3 sentences:"""
-        return self.llm.generate(prompt)
-    def score_response(self, response: str) -> float:
-        criteria = {
-            'logic': 0.4,
-            'evidence': 0.3,
-            'persuasiveness': 0.3
-        }
+    async def _aread_opponents(self, excerpts: List[str]) -> List[Optional[Dict]]:
+        """Opponent model to tailor responses to each excerpt; the baseline keeps none"""
+        return [None] * len(excerpts)
 
-        analysis = self.llm.generate(
-            f"""Rate this response on a scale of 1-10 for:
-            1. Logical consistency
-            2. Evidence quality
-            3. Persuasiveness
-            
-            Response: {response}
-            Return JSON format with keys: logic, evidence, persuasiveness"""
-        )
+    def _response_prompt(self, quote: str, opponent_model: Optional[Dict]) -> str:
+        return self.RESPONSE_TEMPLATE.format_map({
+            'quote': quote,
+            'evidence': random.choice(self._kb_pairs)
+        })
+
+    async def agenerate_response(self, opponent_statement: str) -> str:
+        opponent_model, = await self._aread_opponents([opponent_statement[:self.EXCERPT_CHARS]])
+        prompt = self._response_prompt(opponent_statement[:self.QUOTE_CHARS], opponent_model)
+        return await self.llm.agenerate(prompt, system=self._response_system)
 
+    async def agenerate_scored_response(self, quote: str, opponent_model: Optional[Dict] = None,
+                                        sample: int = 0) -> Tuple[str, float]:
+        """Respond to a pre-sliced statement quote and self-score it in a single LLM call"""
+        prompt = self._response_prompt(quote, opponent_model)
+        reply = await self.llm.agenerate(prompt, max_tokens=220,
+                                         system=self._scored_response_system, sample=sample)
+        response, rubric = _split_scored_reply(reply)
+        if rubric is not None:
+            try:
+                return response, self._weighted_score(rubric)
+            except (KeyError, TypeError):
+                pass
+        # No usable rubric in the reply: score the response text separately
+        return response, await self.ascore_response(response)
+
+    def _weighted_score(self, scores: Dict) -> float:
+        logic, evidence, persuasiveness = self.SCORE_WEIGHTS
+        return (scores['logic'] * logic + scores['evidence'] * evidence
+                + scores['persuasiveness'] * persuasiveness) / 10
+
+    def _parse_score(self, analysis: str) -> float:
         try:
-            scores = json.loads(analysis)
-            return sum(scores[k] * v for k, v in criteria.items()) / 10
-        except Exception:
+            return self._weighted_score(_load_json(analysis))
+        except Exception as e:
+            logging.debug(f"Unparseable score {analysis[:80]!r}: {e}")
             return 0.5  # Default score if parsing fails
+
+    async def _ascore(self, response: str) -> float:
+        return self._parse_score(
+            await self.llm.agenerate(self.SCORE_TEMPLATE.format_map({'response': response}),
+                                     max_tokens=self.SCORE_MAX_TOKENS,
+                                     system=self.SCORE_SYSTEM, temperature=0.0)
+        )
+
+    async def ascore_response(self, response: str) -> float:
+        # Identical leaves within one tree share a single (possibly in-flight) call
+        if response not in self._score_cache:
+            self._score_cache[response] = asyncio.ensure_future(self._ascore(response))
+        return await self._score_cache[response]
     
     
 
-    def visualize_tree(self, tree: DebateNode, filename: str):
-        """Generate debate tree visualization using subprocess"""
+    def visualize_tree(self, tree: DebateNode, filename: str) -> Optional[str]:
+        """Write the debate tree as a .dot file and return its path (see render_dot_files)"""
+        if not self.visualize_enabled:
+            return None
         dot = Digraph()
         def add_nodes(node, parent_id=None):
             node_id = str(id(node))
@@ -100,47 +257,63 @@ class DebateAgent:
                 add_nodes(child, node_id)
         add_nodes(tree)
 
-        # Save .dot file (for debugging)
-        dot.save(f'outputs/{filename}.dot')
-        logging.debug(f".dot file saved as outputs/{filename}.dot")
+        dot_path = f'outputs/{filename}.dot'
+        dot.save(dot_path)
+        logging.debug(f".dot file saved as {dot_path}")
+        return dot_path
 
-        # Render to .png using subprocess
-        try:
-            subprocess.run([
-                'dot',
-                '-Tpng',
-                f'outputs/{filename}.dot',
-                '-o',
-                f'outputs/{filename}.png'
-            ], check=True)
-            logging.info(f"Visualization saved as outputs/{filename}.png")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to render {filename}.png: {str(e)}")
-
-        def score_response(self, response: str) -> float:
-            criteria = {
-                'logic': 0.4,
-                'evidence': 0.3,
-                'persuasiveness': 0.3
-            }
-
-            analysis = self.llm.generate(
-                f"""Rate this response on a scale of 1-10 for:
-                1. Logical consistency
-                2. Evidence quality
-                3. Persuasiveness
-                
-                Response: {response}
-                Return JSON format with keys: logic, evidence, persuasiveness"""
-            )
+def _render_batch(dot_paths: List[str]):
+    try:
+        subprocess.run(['dot', '-Tpng', '-O', *dot_paths], check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        logging.error(f"Failed to render {', '.join(dot_paths)}: {str(e)}")
+        return
+    for dot_path in dot_paths:
+        # -O names the output <input>.png; keep the <filename>.png naming
+        png_path = os.path.splitext(dot_path)[0] + '.png'
+        os.replace(dot_path + '.png', png_path)
+        logging.info(f"Visualization saved as {png_path}")
 
-            try:
-                scores = json.loads(analysis)
-                return sum(scores[k] * v for k, v in criteria.items()) / 10
-            except Exception:
-                return 0.5
+
+def render_dot_files(dot_paths: List[str]):
+    """Render .dot files to PNG, amortizing `dot` process startup over many files"""
+    batches = [dot_paths[i:i + DOT_BATCH_SIZE] for i in range(0, len(dot_paths), DOT_BATCH_SIZE)]
+    if len(batches) <= 1:
+        for batch in batches:
+            _render_batch(batch)
+        return
+    with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+        list(pool.map(_render_batch, batches))
 
 class TheoryOfMindDebater(DebateAgent):
+    # The opponent analysis reads more of the statement than the response prompt
+    EXCERPT_CHARS = 500
+
+    # Tone and approach to take against each opponent emotional state
+    _STRATEGY: ClassVar[Dict[str, Dict[str, str]]] = {
+        'angry': {'tone': 'calm', 'approach': 'acknowledge->refute'},
+        'defensive': {'tone': 'supportive', 'approach': 'find common ground'},
+        'calm': {'tone': 'reasoned', 'approach': 'logical rebuttal'}
+    }
+    _DEFAULT_STRATEGY: ClassVar[Dict[str, str]] = {'tone': 'neutral', 'approach': 'direct'}
+
+    ANALYSIS_SYSTEM = sys.intern("""Analyze the debate statement for:
+            1. Core beliefs (JSON list)
+            2. Emotional state (angry/calm/defensive)
+            3. Argument style (direct/emotional/technical)
+            4. Logical weaknesses (list)
+            Return JSON format.""")
+    ANALYSIS_TEMPLATE = sys.intern("Statement: {statement}")
+
+    RESPONSE_SYSTEM_TEMPLATE = sys.intern("""As {position} debater, answer the opponent using the strategy,
+        tone and evidence given. Max 3 sentences.""")
+    TOM_RESPONSE_TEMPLATE = sys.intern("""- Opponent is feeling {emotional_state}
+        - Strategy: {approach} (tone: {tone})
+        - Target weakness: {weakness}
+
+        Respond to: "{quote}"
+        Use: {evidence}""")
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.opponent_model = {
@@ -150,38 +323,38 @@ class TheoryOfMindDebater(DebateAgent):
             'weaknesses': []
         }
 
-    def update_opponent_model(self, statement: str):
-        analysis = self.llm.generate(
-            f"""Analyze this debate statement for:
-            1. Core beliefs (JSON list)
-            2. Emotional state (angry/calm/defensive)
-            3. Argument style (direct/emotional/technical)
-            4. Logical weaknesses (list)
-            
-            Statement: {statement[:500]}
-            Return JSON format."""
-        )
+    async def _aanalyse(self, excerpt: str) -> Dict:
+        """Opponent model fields set by an analysis of the statement ({} if unparseable)"""
+        analysis = await self.llm.agenerate(self.ANALYSIS_TEMPLATE.format_map({'statement': excerpt}),
+                                            max_tokens=self.ANALYSIS_MAX_TOKENS,
+                                            system=self.ANALYSIS_SYSTEM)
         try:
-            self.opponent_model.update(json.loads(analysis))
-        except:
-            pass
-
-    def generate_response(self, opponent_statement: str) -> str:
-        self.update_opponent_model(opponent_statement)
-
-        strategy = {
-            'angry': {'tone': 'calm', 'approach': 'acknowledge->refute'},
-            'defensive': {'tone': 'supportive', 'approach': 'find common ground'},
-            'calm': {'tone': 'reasoned', 'approach': 'logical rebuttal'}
-        }.get(self.opponent_model['emotional_state'], {'tone': 'neutral', 'approach': 'direct'})
-
-        prompt = f"""As {self.position} debater:
-        - Opponent is feeling {self.opponent_model['emotional_state']}
-        - Strategy: {strategy['approach']} (tone: {strategy['tone']})
-        - Target weakness: {self.opponent_model['weaknesses'][0] if self.opponent_model['weaknesses'] else 'unknown'}
-
-        Respond to: "{opponent_statement[:200]}"
-        Use: {random.choice(self.knowledge_base)}
-        Max 3 sentences."""
-        
-        return self.llm.generate(prompt)
\ No newline at end of file
+            fields = _load_json(analysis)
+        except ValueError:  # orjson.JSONDecodeError is a ValueError
+            return {}
+        return fields if isinstance(fields, dict) else {}
+
+    async def aupdate_opponent_model(self, excerpt: str) -> Dict:
+        opponent_model, = await self._aread_opponents([excerpt])
+        return opponent_model
+
+    def _response_prompt(self, quote: str, opponent_model: Optional[Dict]) -> str:
+        strategy = self._STRATEGY.get(opponent_model['emotional_state'], self._DEFAULT_STRATEGY)
+
+        return self.TOM_RESPONSE_TEMPLATE.format_map({
+            'emotional_state': opponent_model['emotional_state'],
+            'approach': strategy['approach'],
+            'tone': strategy['tone'],
+            'weakness': opponent_model['weaknesses'][0] if opponent_model['weaknesses'] else 'unknown',
+            'quote': quote,
+            'evidence': random.choice(self.knowledge_base)
+        })
+
+    async def _aread_opponents(self, excerpts: List[str]) -> List[Optional[Dict]]:
+        # Each reading layers one analysis over the model as it stood beforehand, so it
+        # never inherits fields from another excerpt's concurrent analysis
+        prior = dict(self.opponent_model)
+        analyses = await asyncio.gather(*(self._aanalyse(excerpt) for excerpt in excerpts))
+        for fields in analyses:  # merged in excerpt order, not completion order
+            self.opponent_model.update(fields)
+        return [{**prior, **fields} for fields in analyses]
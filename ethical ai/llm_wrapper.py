@@ -1,34 +1,201 @@
 # llm_wrapper.py
+import asyncio
+import hashlib
+import itertools
+import os
+from collections import OrderedDict
+import diskcache
 import ollama
-from functools import lru_cache
 import json
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import openai
+except ImportError:
+    openai = None
+
+DISK_CACHE_DIR = 'outputs/.llm_cache'
+# Responses kept in process, in front of the disk cache, for hot repeats
+MEMO_SIZE = 512
+# Keep the model (and its prompt KV cache) resident between debate turns
+KEEP_ALIVE = '30m'
+# OpenAI-compatible endpoint of a vLLM server (continuous batching of concurrent requests)
+VLLM_BASE_URL = 'http://localhost:8000/v1'
+DEFAULT_TEMPERATURE = 0.4
+# Requests kept in flight at once; matches the Ollama server setting of the same name
+OLLAMA_NUM_PARALLEL = int(os.getenv('OLLAMA_NUM_PARALLEL', '4'))
+
+
+def _options(max_tokens: int, temperature: float = DEFAULT_TEMPERATURE) -> dict:
+    return {
+        'temperature': temperature,
+        'num_predict': max_tokens,
+        'num_ctx': 1024,
+        'repeat_penalty': 1.1,
+        'mirostat': 0
+    }
+
+
+def _messages(system: str, prompt: str) -> list:
+    """Fixed instructions go first (as the system turn) so their prefill is reusable"""
+    messages = [{'role': 'system', 'content': system}] if system else []
+    messages.append({'role': 'user', 'content': prompt})
+    return messages
+
+
+@lru_cache(maxsize=1)
+def _disk_cache() -> diskcache.Cache:
+    """Responses persisted across runs; opened on first use"""
+    return diskcache.Cache(DISK_CACHE_DIR)
+
+
+def _disk_get(key: bytes):
+    return _disk_cache().get(key)
+
+
+def _disk_set(key: bytes, text: str):
+    _disk_cache().set(key, text)
+
+
+def _cache_key(backend: str, model: str, system: str, prompt: str, max_tokens: int,
+               temperature: float, sample: int) -> bytes:
+    # Key on the full sampling options sent to the backend, so changing any of them
+    # invalidates old entries
+    if backend == 'vllm':
+        options = _vllm_params(max_tokens, temperature)
+    else:
+        options = _options(max_tokens, temperature)
+    return hashlib.blake2b(
+        f"{backend}|{model}|{system}|{prompt}|{json.dumps(options, sort_keys=True)}|{sample}".encode()
+    ).digest()
+
+
+def _vllm_params(max_tokens: int, temperature: float) -> dict:
+    """vLLM equivalents of the Ollama sampling options"""
+    options = _options(max_tokens, temperature)
+    return {
+        'temperature': options['temperature'],
+        'max_tokens': max_tokens,
+        'extra_body': {'repetition_penalty': options['repeat_penalty']}
+    }
+
 
 class LLMWrapper:
-    def __init__(self, model: str = 'phi3:instruct'):
+    def __init__(self, model: str = 'phi3:instruct', backend: str = 'ollama',
+                 base_url: str = VLLM_BASE_URL, max_concurrency: int = OLLAMA_NUM_PARALLEL,
+                 cache: Optional[bool] = None):
+        if backend not in ('ollama', 'vllm'):
+            raise ValueError(f"Unknown backend {backend!r}; expected 'ollama' or 'vllm'")
+        if backend == 'vllm' and openai is None:
+            raise RuntimeError("The vllm backend requires the openai package")
         self.model = model
+        self.backend = backend
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        # Replaying earlier replies is on unless disabled here or with DEBATE_CACHE=0
+        if cache is None:
+            cache = os.getenv('DEBATE_CACHE', '1') != '0'
+        self.cache_enabled = cache
+        self._async_client = None
+        self._async_loop = None
+        self._queue = None
+        self._consumers = []
+        self._sequence = itertools.count()
+        self._memo: OrderedDict = OrderedDict()
         self._warmup_model()
 
     def _warmup_model(self):
         """Pre-load model to reduce first-response latency"""
         try:
-            ollama.generate(model=self.model, prompt='ping')
+            if self.backend == 'vllm':
+                openai.OpenAI(base_url=self.base_url, api_key='EMPTY').models.list()
+            else:
+                ollama.generate(model=self.model, prompt='ping', keep_alive=KEEP_ALIVE)
         except Exception as e:
             raise RuntimeError(f"Failed to load model {self.model}: {e}")
 
-    @lru_cache(maxsize=100)
-    def generate(self, prompt: str, max_tokens: int = 150) -> str:
-        """Cached generation with optimized parameters"""
-        try:
-            response = ollama.chat(
+    def _bind_loop(self):
+        """Create the async client, request queue and its consumers for the running loop
+        (httpx pools and asyncio queues cannot be shared across event loops)"""
+        loop = asyncio.get_running_loop()
+        if self._async_loop is loop:
+            return
+        if self.backend == 'vllm':
+            self._async_client = openai.AsyncOpenAI(base_url=self.base_url, api_key='EMPTY')
+        else:
+            self._async_client = ollama.AsyncClient()
+        self._queue = asyncio.PriorityQueue()
+        self._consumers = [loop.create_task(self._consume(self._queue))
+                           for _ in range(self.max_concurrency)]
+        self._async_loop = loop
+
+    async def _consume(self, queue: asyncio.PriorityQueue):
+        """Consumer: whichever one is free takes the next pending request, so a slow
+        generation never holds back work queued behind it by another agent"""
+        while True:
+            _, _, future, request = await queue.get()
+            try:
+                if not future.cancelled():
+                    future.set_result(await self._request(*request))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                queue.task_done()
+
+    async def _request(self, system: str, prompt: str, max_tokens: int, temperature: float) -> str:
+        if self.backend == 'vllm':
+            response = await self._async_client.chat.completions.create(
                 model=self.model,
-                messages=[{'role': 'user', 'content': prompt}],
-                options={
-                    'temperature': 0.4,
-                    'num_predict': max_tokens,
-                    'num_ctx': 1024,
-                    'repeat_penalty': 1.1
-                }
+                messages=_messages(system, prompt),
+                **_vllm_params(max_tokens, temperature)
             )
-            return response['message']['content'].strip()
-        except Exception as e:
-            return f"API Error: {str(e)}"
\ No newline at end of file
+            return response.choices[0].message.content.strip()
+        response = await self._async_client.chat(
+            model=self.model,
+            messages=_messages(system, prompt),
+            options=_options(max_tokens, temperature),
+            keep_alive=KEEP_ALIVE
+        )
+        return response['message']['content'].strip()
+
+    async def submit(self, prompt: str, max_tokens: int = 150, system: str = '',
+                     temperature: float = DEFAULT_TEMPERATURE) -> str:
+        """Queue a request for the shared consumer pool and wait for its reply"""
+        self._bind_loop()
+        future = asyncio.get_running_loop().create_future()
+        # Shortest prompt first so long prefills do not head-of-line block short ones
+        self._queue.put_nowait((len(prompt), next(self._sequence), future,
+                                (system, prompt, max_tokens, temperature)))
+        return await future
+
+    def _remember(self, key: bytes, text: str):
+        self._memo[key] = text
+        self._memo.move_to_end(key)
+        if len(self._memo) > MEMO_SIZE:
+            self._memo.popitem(last=False)
+
+    async def agenerate(self, prompt: str, max_tokens: int = 150, system: str = '',
+                        temperature: float = DEFAULT_TEMPERATURE, sample: int = 0) -> str:
+        """Non-blocking generation so independent prompts can be in flight together"""
+        if not self.cache_enabled:
+            try:
+                return await self.submit(prompt, max_tokens, system, temperature)
+            except Exception as e:
+                return f"API Error: {str(e)}"
+        # `sample` tells repeated draws of one sampled prompt apart (e.g. sibling branches),
+        # so a warm cache does not hand every sibling the same reply
+        key = _cache_key(self.backend, self.model, system, prompt, max_tokens, temperature, sample)
+        text = self._memo.get(key)
+        if text is None:
+            # diskcache is sqlite-backed: keep its I/O off the event loop
+            text = await asyncio.to_thread(_disk_get, key)
+        if text is None:
+            try:
+                text = await self.submit(prompt, max_tokens, system, temperature)
+            except Exception as e:
+                return f"API Error: {str(e)}"
+            await asyncio.to_thread(_disk_set, key, text)
+        self._remember(key, text)
+        return text
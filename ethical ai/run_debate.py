@@ -1,9 +1,10 @@
 # run_debate.py
+import asyncio
 import logging
 import os
 from datetime import datetime
 from llm_wrapper import LLMWrapper
-from debate_system import DebateAgent, TheoryOfMindDebater
+from debate_system import DebateAgent, TheoryOfMindDebater, render_dot_files
 import sys
 import io
 
@@ -33,55 +34,67 @@ CON_KNOWLEDGE = [
     "Over-reliance erases critical thinking skills (Neuroscience Journal)"
 ]
 
-def run_debate(agent1, agent2, name_suffix):
+async def run_debate(agent1, agent2, name_suffix):
     logging.info(f"\n--- {name_suffix.upper()} DEBATE ---")
     topic = "AI should be widely adopted in college education"
     logging.info(f"TOPIC: {topic}\n")
 
     current_statement = topic
+    dot_paths = []
     for round_num in range(3):
         logging.info(f"\nROUND {round_num + 1}")
-        response1 = agent1.generate_response(current_statement)
+        response1 = await agent1.agenerate_response(current_statement)
         logging.info(f"{agent1.position}: {response1}")
         current_statement = response1
 
-        response2 = agent2.generate_response(current_statement)
+        response2 = await agent2.agenerate_response(current_statement)
         logging.info(f"{agent2.position}: {response2}")
         current_statement = response2
 
         if round_num == 2:
-            tree1 = agent1.build_rehearsal_tree(response2)
+            # Both trees feed the same LLM request queue, so neither waits on the other
+            tree1, tree2 = await asyncio.gather(
+                agent1.build_rehearsal_tree(response2),
+                agent2.build_rehearsal_tree(response1)
+            )
             path1 = agent1.select_best_path(tree1)
             logging.info("\nPRO TREE PATH:")
             for i, node in enumerate(path1):
                 logging.info(f"Step {i+1}: {node.content[:60]}...")
 
-            tree2 = agent2.build_rehearsal_tree(response1)
             path2 = agent2.select_best_path(tree2)
             logging.info("\nCON TREE PATH:")
             for i, node in enumerate(path2):
                 logging.info(f"Step {i+1}: {node.content[:60]}...")
 
-            try:
-                agent1.visualize_tree(tree1, f"{name_suffix}_pro_final_tree")
-                agent2.visualize_tree(tree2, f"{name_suffix}_con_final_tree")
-            except Exception as e:
-                logging.warning("Tree visualization failed (Graphviz not installed). Skipping.")
+            if agent1.visualize_enabled or agent2.visualize_enabled:
+                try:
+                    for agent, tree, side in ((agent1, tree1, "pro"), (agent2, tree2, "con")):
+                        dot_path = agent.visualize_tree(tree, f"{name_suffix}_{side}_final_tree")
+                        if dot_path:
+                            dot_paths.append(dot_path)
+                except OSError as e:
+                    logging.warning(f"Failed to write tree visualization: {e}")
 
     logging.info(f"\n{name_suffix.upper()} DEBATE COMPLETE\n")
+    return dot_paths
 
-def main():
-    llm = LLMWrapper(model='phi3:instruct')
+async def main():
+    llm = LLMWrapper(model=os.getenv('DEBATE_MODEL', 'phi3:instruct'),
+                     backend=os.getenv('DEBATE_BACKEND', 'ollama'))
 
     # Baseline agents
     baseline_pro = DebateAgent("PRO", llm, PRO_KNOWLEDGE)
     baseline_con = DebateAgent("CON", llm, CON_KNOWLEDGE)
-    run_debate(baseline_pro, baseline_con, "baseline")
+    dot_paths = await run_debate(baseline_pro, baseline_con, "baseline")
 
     # Enhanced agents
     enhanced_pro = TheoryOfMindDebater("PRO+", llm, PRO_KNOWLEDGE)
     enhanced_con = TheoryOfMindDebater("CON+", llm, CON_KNOWLEDGE)
-    run_debate(enhanced_pro, enhanced_con, "enhanced")
+    dot_paths += await run_debate(enhanced_pro, enhanced_con, "enhanced")
+
+    # Render every tree together: one `dot` process instead of one per tree
+    render_dot_files(dot_paths)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file